@@ -1,33 +1,103 @@
 """Module provides methods for sequential data transfer from Postgres to Elasticsearch.
 
-Number of records in batch could be set up in TRANSFER_BATCH_SIZE. Certain number of records,
-according batch size, will be fetched from Postgres and immediately upload to Elasticsearch.
+Number of records fetched from Postgres in one batch could be set up in PG_FETCH_SIZE.
+Certain number of records, according batch size, will be fetched from Postgres and immediately
+upload to Elasticsearch in bulk requests of ES_MAX_CHUNK_BYTES. Number of documents in one
+request is estimated from the size of the first documents and kept between ES_MIN_CHUNK_SIZE
+and ES_MAX_CHUNK_SIZE.
 Then the process will be repeated untill all data from Postgres would be transfered to Elasticsearch.
 """
-import json
 import logging
 import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from itertools import chain, islice
 import signal
 import sys
 from logging import config
 from os.path import dirname, join
 from time import sleep
-from typing import Any, Optional, Sequence
+from typing import Iterable, Iterator, Optional
 
 import elasticsearch
+import orjson
 import psycopg2
-from elasticsearch.helpers import bulk
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import BulkIndexError
+from psycopg2.extensions import connection as PGconnection
+from psycopg2.sql import SQL, Identifier
 
-from sql import SQL_FOR_UPDATE_FILMWORK_INDEX
+from sql import (
+    SQL_CREATE_UPDATED_AT_INDEXES,
+    SQL_DROP_INDEX,
+    SQL_FOR_FILMWORK_INDEX,
+    SQL_FOR_UPDATED_FILMWORK_IDS,
+    SQL_INVALID_INDEXES,
+    SQL_IS_PREPARED,
+    SQL_PREPARE_UPDATED_FILMWORK_IDS,
+)
+from utils.backoff import backoff
 from utils.connections import ElasticConnection, PostgresConnection
 from utils.etl_state import JsonFileStorage, State
 from utils.logging_config import LOGGING_CONFIG
+from utils.pipeline import iterate_queue, start_stage
 
 config.dictConfig(LOGGING_CONFIG)
 logger = logging.getLogger('main')
 
-TRANSFER_BATCH_SIZE = 500
+# number of records fetched from Postgres at once
+PG_FETCH_SIZE = 2000
+# maximum size of one bulk request to Elasticsearch
+ES_MAX_CHUNK_BYTES = 50 * 1024 * 1024
+# limits for number of documents sent to Elasticsearch in one bulk request
+ES_MIN_CHUNK_SIZE = 50
+ES_MAX_CHUNK_SIZE = 5000
+# number of first documents used to estimate average document size
+CHUNK_SIZE_SAMPLE = 32
+# max number of batches waiting between ETL stages
+PIPELINE_QUEUE_SIZE = 4
+# number of threads sending bulk requests to Elasticsearch
+ES_THREAD_COUNT = os.cpu_count() or 1
+# retries of documents rejected by overloaded Elasticsearch, delays are in seconds
+ES_MAX_RETRIES = 10
+ES_INITIAL_BACKOFF = 1
+ES_MAX_BACKOFF = 60
+# max number of chunks sent or waiting for a free thread
+ES_MAX_CHUNKS_IN_FLIGHT = 2 * ES_THREAD_COUNT
+# save point used when ETL is run for the first time
+DEFAULT_LATEST_UPDATE = '-infinity'
+DEFAULT_LATEST_ID = '00000000-0000-0000-0000-000000000000'
+# Index settings for the first massive load: rare refreshes and translog
+# fsyncs, no replicas to copy documents to
+ES_BULK_INDEX_SETTINGS = {
+    'refresh_interval': '30s',
+    'number_of_replicas': 0,
+    'translog': {
+        'durability': 'async',
+        'sync_interval': '30s',
+        'flush_threshold_size': '1gb',
+    },
+}
+# Index settings for serving search requests, used after loading is completed
+ES_LIVE_INDEX_SETTINGS = {
+    'refresh_interval': '1s',
+    'number_of_replicas': 1,
+    'translog': {
+        'durability': 'request',
+        'flush_threshold_size': '512mb',
+    },
+}
+# Documents are copied from the template, which is already sized for all
+# fields, instead of being built from scratch for every film_work
+DOCUMENT_TEMPLATE = dict.fromkeys((
+    'id', 'imdb_rating', 'genre', 'title', 'description', 'director',
+    'actors_names', 'writers_names', 'actors', 'writers',
+))
+# (latest_update, id) of film_work which ETL process could be continued after
+SavePoint = tuple[datetime, str]
 # path for ElasticSearch index schema
 SCHEMA_PATH = join(dirname(__file__), 'es_schema.json')
 # path for ETL latest state
@@ -37,140 +107,332 @@ STATE_PATH = join(dirname(__file__), 'data/etl_state.json')
 class ETL:
     """Extracts data from Postges then load it to ElasticSearch."""
 
-    def extract(self) -> Optional[list[tuple]]:
+    def __init__(self) -> None:
+        # state instance is shared by extract and load
+        self.state = State(JsonFileStorage(STATE_PATH))
+        # indexes in Postgres are checked once per process
+        self.db_indexes_checked = False
+
+    def extract(self) -> Iterator[list[tuple]]:
         """Retrieve data from Postgres.
         Keeps state of the last call to continue retrieving data starting from
-        the save point.
+        the save point. Updated film_works are paged by (latest_update, id) key,
+        PG_FETCH_SIZE film_works at once.
         """
         logger.info('Searching for updates in Postgres db')
-        state = self.get_state_object()
-        latest_update: str = state.get_state(key='latest_update')
-
         while True:
+            # state is re-read on reconnect, so already loaded batches are skipped
+            latest_update: str | datetime = self.state.get_state(key='latest_update') or DEFAULT_LATEST_UPDATE
+            latest_id: str = self.state.get_state(key='latest_id') or DEFAULT_LATEST_ID
             logger.info('Getting connection with Postgres db ...')
             pg_connection = PostgresConnection()
             conn = pg_connection.get_connection()
             logger.info('Connection with Postgres was successfully established')
+            try:
+                if not self.db_indexes_checked:
+                    self.create_db_indexes(conn)
+                    self.db_indexes_checked = True
+                self.prepare_statements(conn)
+                has_updates = False
+                while True:
+                    with conn.cursor() as cur:
+                        cur.execute(SQL_FOR_UPDATED_FILMWORK_IDS, (latest_update, latest_id, PG_FETCH_SIZE))
+                        page = cur.fetchall()
+                    if not page:
+                        break
+                    latest_updates = dict(page)
+                    with conn.cursor() as cur:
+                        cur.execute(SQL_FOR_FILMWORK_INDEX, ([filmwork_id for filmwork_id, _ in page],))
+                        data = [(*row, latest_updates[row[0]]) for row in cur.fetchall()]
+                    conn.commit()
+                    if not has_updates:
+                        logger.info('Uploading data from Postgres to Elastic started')
+                        has_updates = True
+                    yield data
+                    latest_id, latest_update = page[-1]
+                if not has_updates:
+                    logger.info('No updates available')
+            except (psycopg2.OperationalError, psycopg2.errors.AdminShutdown):
+                logger.error('Lost connection with Postgres. Try to reconnect.')
+                # closed connection is reopened on the next get_connection call
+                conn.close()
+                continue
+            except Exception:
+                logger.exception('Postgres db crashed ')
+                break
+            else:
+                break
+            finally:
+                # connection is kept open for the next run, but not inside transaction
+                if not conn.closed:
+                    conn.rollback()
+
+    def create_db_indexes(self, conn: PGconnection) -> None:
+        """Creates indexes used for searching updates, if they aren't already there.
+        Indexes are built concurrently in autocommit mode, so they don't lock tables for writes.
+        Indexes left invalid by a failed build are dropped and built again.
+        """
+        conn.autocommit = True
+        try:
             with conn.cursor() as cur:
-                try:
-                    # With provided sql script all updated data for film_works,
-                    # persons and genres are selected in one query
-                    cur.execute(
-                        SQL_FOR_UPDATE_FILMWORK_INDEX,
-                        (latest_update, latest_update, latest_update, TRANSFER_BATCH_SIZE)
-                    )
-                except (psycopg2.OperationalError, psycopg2.errors.AdminShutdown):
-                    logger.error('Lost connection with Postgres. Try to reconnect.')
-                    continue
-                except Exception:
-                    logger.exception('Postgres db crashed ')
-                    break
-                else:
-                    data = cur.fetchall()
-                    message = 'Uploading data from Postgres to Elastic started' if data else 'No updates available'
-                    logger.info(message)
-                    return data
-
-        return None
-
-    def transform(self, data: list[tuple]) -> dict[str, Sequence[Any] | datetime]:
-        """Transforms raw data to required by ElasticSearch format."""
+                cur.execute(SQL_INVALID_INDEXES, (list(SQL_CREATE_UPDATED_AT_INDEXES),))
+                for (index_name,) in cur.fetchall():
+                    logger.warning(f'Index {index_name} in Postgres db is invalid and will be rebuilt')
+                    cur.execute(SQL(SQL_DROP_INDEX).format(Identifier(index_name)))
+                for query in SQL_CREATE_UPDATED_AT_INDEXES.values():
+                    cur.execute(query)
+        except psycopg2.errors.InsufficientPrivilege:
+            logger.warning('Not enough privileges to create indexes in Postgres db')
+        finally:
+            # connection lost during a build is closed, its error is handled by extract
+            if not conn.closed:
+                conn.autocommit = False
+
+    def prepare_statements(self, conn: PGconnection) -> None:
+        """Prepares queries repeated on every page, if connection doesn't have them yet."""
+        with conn.cursor() as cur:
+            cur.execute(SQL_IS_PREPARED, ('updated_filmwork_ids',))
+            if not cur.fetchone()[0]:
+                cur.execute(SQL_PREPARE_UPDATED_FILMWORK_IDS)
+
+    def transform(self, data: list[tuple]) -> list[tuple[bytes, SavePoint]]:
+        """Transforms raw data to required by ElasticSearch format.
+        Every document is encoded as action and source lines of bulk request
+        and paired with its save point.
+        """
         prepared_data = []
+        add_prepared = prepared_data.append
         for id, rating, title, description, persons, genres, latest_update in data:
-            genre = [*{item['genre'] for item in genres if item.get('genre')}]
+            genre_names = set()
+            for item in genres:
+                genre_name = item.get('genre')
+                if genre_name:
+                    genre_names.add(genre_name)
+            genre = [*genre_names]
             actors_names, actors, writers_names, writers, directors_names = [], [], [], [], []
-            unique_persons = ({person['id']: person for person in persons}.values())
-            for person in unique_persons:
-                if not person.get('role'):
+            # persons are already distinct by (id, role) in SQL, so a person credited
+            # in several roles gets into every one of them
+            for person in persons:
+                role = person.get('role')
+                if not role:
                     continue
-                person_info = {'id': person['id'], 'name': person['full_name']}
-                if person['role'] == 'actor':
-                    actors_names.append(person['full_name'])
-                    actors.append(person_info)
-                elif person['role'] == 'writer':
-                    writers_names.append(person['full_name'])
-                    writers.append(person_info)
-                elif person['role'] == 'director':
-                    directors_names.append(person['full_name'])
-
-            doc = {
-                '_id': id,
-                'id': id,
-                'imdb_rating': rating,
-                'genre': genre,
-                'title': title,
-                'description': description,
-                'director': directors_names or None,
-                'actors_names': actors_names or None,
-                'writers_names': writers_names or None,
-                'actors': actors,
-                'writers': writers,
-            }
-            prepared_data.append(doc)
-
-        return {
-            'prepared_data': prepared_data,
-            'latest_update': latest_update
-        }
-
-    def load(self, data: dict[str, Any]) -> None:
+                person_id = person['id']
+                full_name = person['full_name']
+                if role == 'actor':
+                    actors_names.append(full_name)
+                    actors.append({'id': person_id, 'name': full_name})
+                elif role == 'writer':
+                    writers_names.append(full_name)
+                    writers.append({'id': person_id, 'name': full_name})
+                elif role == 'director':
+                    directors_names.append(full_name)
+
+            doc = DOCUMENT_TEMPLATE.copy()
+            doc['id'] = id
+            doc['imdb_rating'] = rating
+            doc['genre'] = genre
+            doc['title'] = title
+            doc['description'] = description
+            doc['director'] = directors_names or None
+            doc['actors_names'] = actors_names or None
+            doc['writers_names'] = writers_names or None
+            doc['actors'] = actors
+            doc['writers'] = writers
+            # Documents are encoded to lines of bulk request body right away, so
+            # Elasticsearch client doesn't walk and serialize them once again.
+            # Ids are UUIDs and don't need escaping.
+            add_prepared((
+                b'{"index":{"_id":"' + id.encode() + b'"}}\n' + orjson.dumps(doc) + b'\n',
+                (latest_update, id),
+            ))
+
+        return prepared_data
+
+    def get_chunk_size(self, sample: list[tuple[bytes, SavePoint]]) -> int:
+        """Returns number of documents which fit into ES_MAX_CHUNK_BYTES
+        according to average size of sampled documents.
+        """
+        if not sample:
+            return ES_MIN_CHUNK_SIZE
+        avg_doc_size = sum(len(doc) for doc, _ in sample) / len(sample)
+        return max(ES_MIN_CHUNK_SIZE, min(ES_MAX_CHUNK_SIZE, int(ES_MAX_CHUNK_BYTES // avg_doc_size)))
+
+    def iterate_chunks(
+        self, docs: Iterable[tuple[bytes, SavePoint]], chunk_size: int,
+    ) -> Iterator[tuple[list[bytes], SavePoint]]:
+        """Groups encoded documents into chunks of ``chunk_size`` documents,
+        but not bigger than ES_MAX_CHUNK_BYTES.
+        Every chunk is paired with save point of its last document.
+        """
+        chunk: list[bytes] = []
+        chunk_bytes = 0
+        chunk_save_point: Optional[SavePoint] = None
+        for doc, save_point in docs:
+            if chunk and (len(chunk) == chunk_size or chunk_bytes + len(doc) > ES_MAX_CHUNK_BYTES):
+                yield chunk, chunk_save_point
+                chunk, chunk_bytes = [], 0
+            chunk.append(doc)
+            chunk_bytes += len(doc)
+            chunk_save_point = save_point
+        if chunk:
+            yield chunk, chunk_save_point
+
+    @backoff(exception=elasticsearch.ConnectionError, initial_backoff=1, max_backoff=60, max_retries=10)
+    def send_bulk(self, client: Elasticsearch, chunk: list[bytes]) -> dict:
+        """Sends chunk of encoded documents in one bulk request."""
+        # Only fields needed to find failed documents are returned for every item,
+        # and items are walked only if Elasticsearch reports errors
+        return client.transport.perform_request(
+            'POST',
+            '/movies/_bulk',
+            headers={'content-type': 'application/x-ndjson'},
+            params={'filter_path': 'errors,items.*._id,items.*.status,items.*.error'},
+            body=b''.join(chunk),
+        )
+
+    def send_chunk(self, client: Elasticsearch, chunk: list[bytes]) -> int:
+        """Sends chunk of encoded documents to Elasticsearch.
+        Documents rejected by overloaded Elasticsearch (429) are resent with
+        exponential backoff, like ``elasticsearch.helpers.bulk`` does.
+        Raises BulkIndexError if any document wasn't indexed, so the save point
+        of the chunk isn't saved and it will be extracted again.
+        Returns number of indexed documents.
+        """
+        documents_count = len(chunk)
+        for retry_number in range(ES_MAX_RETRIES + 1):
+            if retry_number:
+                delay = min(ES_INITIAL_BACKOFF * 2 ** (retry_number - 1), ES_MAX_BACKOFF)
+                logger.info(f'{len(chunk)} documents were rejected by Elastic, resend after {delay} seconds')
+                sleep(delay)
+            response = self.send_bulk(client, chunk)
+            if not response['errors']:
+                return documents_count
+            rejected, failed = [], []
+            for doc, item in zip(chunk, response['items']):
+                result = item['index']
+                if result['status'] == 429:
+                    rejected.append(doc)
+                elif 'error' in result:
+                    failed.append(result)
+                    logger.error(f'Failed to upload document {result["_id"]} to Elastic '
+                                 f'(status {result["status"]}): {result["error"]}')
+            if failed:
+                raise BulkIndexError(f'{len(failed)} document(s) failed to index.', failed)
+            chunk = rejected
+        raise BulkIndexError(f'{len(chunk)} document(s) were rejected by Elastic.', [])
+
+    def load(self, data: Iterable[list[tuple[bytes, SavePoint]]]) -> None:
         """Load data to Elasticsearch.
         Keeps state of the last call to continue loading data starting from
-        the save point.
+        the save point. Chunks are sent by ES_THREAD_COUNT threads, state is saved
+        once per chunk acknowledged by Elasticsearch.
+
+        Data can be iterated only once, so uploading isn't restarted if connection
+        is lost. Every chunk is retried by itself, and if it still fails uploading
+        is stopped. The rest of data will be extracted again from the save point
+        on the next run.
         """
-        state = self.get_state_object()
-        while True:
-            logger.info('Getting connection with Elastic db ...')
-            es_connection = ElasticConnection()
-            client = es_connection.get_client()
-            logger.info('Connection with Elastic was successfully established')
-            try:
-                self.create_index(client)
-                success, _ = bulk(
-                    client=client,
-                    index='movies',
-                    actions=data['prepared_data'],
-                    chunk_size=TRANSFER_BATCH_SIZE,
-                    max_retries=1000,
-                    initial_backoff=1,
-                    max_backoff=300,
-                )
-            except elasticsearch.ConnectionError:
-                logger.error('Lost connection with Elastic. Try to reconnect.')
-                continue
-            except Exception:
-                logger.exception('Elastic db crashed ')
-                break
-            else:
-                logger.info('Uploading data from Postgres to Elastic completed - '
-                            f'{success} rows were synchronized')
-                latest_update = data['latest_update'].strftime('%Y-%m-%d %H:%M:%S.%f')
-                state.set_state(key='latest_update', value=latest_update)
-                logger.info('ETL state was updated')
-                break
+        logger.info('Getting connection with Elastic db ...')
+        es_connection = ElasticConnection()
+        client = es_connection.get_client()
+        logger.info('Connection with Elastic was successfully established')
+        executor = ThreadPoolExecutor(max_workers=ES_THREAD_COUNT)
+        try:
+            self.create_index(client)
+            success = 0
+            docs = chain.from_iterable(data)
+            sample = list(islice(docs, CHUNK_SIZE_SAMPLE))
+            chunk_size = self.get_chunk_size(sample)
+            if sample:
+                logger.info(f'Documents are uploaded to Elastic in chunks of {chunk_size}')
+            # Chunks are acknowledged in the order they were sent, so the state
+            # never gets ahead of documents which are still being uploaded
+            in_flight: deque = deque()
+            for chunk, save_point in self.iterate_chunks(chain(sample, docs), chunk_size):
+                in_flight.append((executor.submit(self.send_chunk, client, chunk), save_point))
+                if len(in_flight) > ES_MAX_CHUNKS_IN_FLIGHT:
+                    success += self.acknowledge_chunk(*in_flight.popleft())
+            while in_flight:
+                success += self.acknowledge_chunk(*in_flight.popleft())
+        except elasticsearch.ConnectionError:
+            logger.error('Lost connection with Elastic. Uploading will be continued from the save point.')
+        except BulkIndexError as e:
+            logger.error(f'{e.args[0]} Uploading will be continued from the save point.')
+        except Exception:
+            logger.exception('Elastic db crashed ')
+        else:
+            if self.has_bulk_index_settings(client):
+                self.restore_index_settings(client)
+            logger.info('Uploading data from Postgres to Elastic completed - '
+                        f'{success} rows were synchronized')
+        finally:
+            # chunks waiting for a free thread are not sent after failure
+            executor.shutdown(cancel_futures=True)
+
+    def acknowledge_chunk(self, sent_chunk: Future, save_point: SavePoint) -> int:
+        """Waits for chunk to be uploaded and saves its save point.
+        Returns number of successfully indexed documents.
+        """
+        success = sent_chunk.result()
+        self.save_state(save_point)
+        return success
+
+    def save_state(self, save_point: SavePoint) -> None:
+        """Saves the latest uploaded film_work as ETL save point."""
+        latest_update, latest_id = save_point
+        self.state.update_state({
+            'latest_update': latest_update.strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'latest_id': latest_id,
+        })
+        logger.info('ETL state was updated')
 
     def create_index(self, client):
-        """Creates an index in Elasticsearch if one isn't already there."""
-        with open(SCHEMA_PATH, 'r') as schema:
-            client.indices.create(
-                index='movies',
-                body=json.load(schema),
-                ignore=400,
-            )
-
-    def get_state_object(self) -> State:
-        """Returns state instance."""
-        storage = JsonFileStorage(STATE_PATH)
-        return State(storage)
+        """Creates an index in Elasticsearch if one isn't already there.
+        New index is created with settings for the first massive load,
+        they are replaced with ES_LIVE_INDEX_SETTINGS after loading.
+        """
+        with open(SCHEMA_PATH, 'rb') as schema:
+            body = orjson.loads(schema.read())
+        body['settings'].update(ES_BULK_INDEX_SETTINGS)
+        client.indices.create(
+            index='movies',
+            body=body,
+            ignore=400,
+        )
+
+    def has_bulk_index_settings(self, client) -> bool:
+        """Checks if the index still has settings for the first massive load.
+        Settings are read from the index itself, so they are restored even if
+        the first load was interrupted and completed by another process.
+        """
+        response = client.indices.get_settings(
+            index='movies',
+            name='index.translog.durability',
+            flat_settings=True,
+        )
+        return response['movies']['settings'].get('index.translog.durability') == 'async'
+
+    def restore_index_settings(self, client):
+        """Restores index settings changed for the first massive load."""
+        client.indices.put_settings(index='movies', body={'index': ES_LIVE_INDEX_SETTINGS})
 
     def run(self) -> None:
         """Runs ETL processes."""
-        while True:
-            raw_data = self.extract()
-            if not raw_data:
-                break
-            prepared_data = self.transform(raw_data)
-            self.load(prepared_data)
+        # Extract and transform are run in their own threads, so reading from
+        # Postgres and preparing documents overlap uploading to Elasticsearch
+        raw_queue: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        doc_queue: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        stop_event = threading.Event()
+        stages = [
+            start_stage(self.extract(), raw_queue, stop_event),
+            start_stage(map(self.transform, iterate_queue(raw_queue, stop_event)), doc_queue, stop_event),
+        ]
+        try:
+            self.load(iterate_queue(doc_queue, stop_event))
+        finally:
+            stop_event.set()
+            for stage in stages:
+                stage.join()
 
 
 if __name__ == '__main__':
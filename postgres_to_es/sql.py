@@ -1,16 +1,88 @@
-SQL_FOR_UPDATE_FILMWORK_INDEX = """
+# Page of updated film_works is selected on every iteration, so the query is
+# prepared once per connection to skip parsing and planning
+SQL_IS_PREPARED = """
+    SELECT EXISTS (SELECT 1 FROM pg_prepared_statements WHERE name = %s);
+"""
+
+# Every branch selects updates of one table, so it is served by the index on
+# its updated_at column. Branches use >= to keep film_works with the same
+# latest_update as the save point, they are filtered out by the (latest_update, id) key.
+SQL_PREPARE_UPDATED_FILMWORK_IDS = """
+    PREPARE updated_filmwork_ids AS
+    SELECT id, MAX(updated_at) AS latest_update
+    FROM (
+        SELECT fw.id, fw.updated_at
+        FROM content.film_work fw
+        WHERE fw.updated_at >= $1
+        UNION ALL
+        SELECT pfw.film_work_id, p.updated_at
+        FROM content.person p
+        JOIN content.person_film_work pfw ON p.id = pfw.person_id
+        WHERE p.updated_at >= $1
+        UNION ALL
+        SELECT gfw.film_work_id, g.updated_at
+        FROM content.genre g
+        JOIN content.genre_film_work gfw ON g.id = gfw.genre_id
+        WHERE g.updated_at >= $1
+    ) AS updated
+    GROUP BY id
+    HAVING (MAX(updated_at), id) > ($1, $2)
+    ORDER BY latest_update, id
+    LIMIT $3;
+"""
+
+SQL_FOR_UPDATED_FILMWORK_IDS = """
+    EXECUTE updated_filmwork_ids (%s, %s, %s);
+"""
+
+# Persons and genres are aggregated by correlated subqueries, so they are
+# deduplicated by Postgres and joins don't multiply each other
+SQL_FOR_FILMWORK_INDEX = """
     SELECT
         fw.id, fw.rating, fw.title, fw.description,
-        jsonb_agg(jsonb_build_object('id', p.id, 'full_name', p.full_name, 'role', pfw.role)) AS persons,
-        jsonb_agg(jsonb_build_object('id', g.id, 'genre', g.name)) AS genres,
-        GREATEST(fw.updated_at, MAX(p.updated_at), MAX(g.updated_at)) AS latest_update
-    FROM content.film_work fw
-    LEFT OUTER JOIN content.person_film_work pfw ON fw.id = pfw.film_work_id
-    LEFT OUTER JOIN content.person p ON p.id = pfw.person_id
-    LEFT OUTER JOIN content.genre_film_work gfw ON fw.id = gfw.film_work_id
-    LEFT OUTER JOIN content.genre g ON gfw.genre_id = g.id
-    WHERE fw.updated_at > %s or p.updated_at > %s or g.updated_at > %s
-    GROUP BY fw.id
-    ORDER BY latest_update
-    LIMIT %s;
+        COALESCE((
+            SELECT jsonb_agg(DISTINCT jsonb_build_object('id', p.id, 'full_name', p.full_name, 'role', pfw.role))
+            FROM content.person_film_work pfw
+            JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+        ), '[]') AS persons,
+        COALESCE((
+            SELECT jsonb_agg(DISTINCT jsonb_build_object('id', g.id, 'genre', g.name))
+            FROM content.genre_film_work gfw
+            JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+        ), '[]') AS genres
+    FROM unnest(%s::uuid[]) WITH ORDINALITY AS page(id, position)
+    JOIN content.film_work fw ON fw.id = page.id
+    ORDER BY page.position;
+"""
+
+# Indexes are built concurrently, so writes to the tables aren't blocked while
+# they are built. CREATE INDEX CONCURRENTLY can't run inside a transaction block,
+# so every statement is executed by itself.
+SQL_CREATE_UPDATED_AT_INDEXES = {
+    'film_work_updated_at_idx':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS film_work_updated_at_idx ON content.film_work (updated_at);",
+    'person_updated_at_idx':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS person_updated_at_idx ON content.person (updated_at);",
+    'genre_updated_at_idx':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS genre_updated_at_idx ON content.genre (updated_at);",
+    'person_film_work_person_idx':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS person_film_work_person_idx ON content.person_film_work (person_id);",
+    'genre_film_work_genre_idx':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS genre_film_work_genre_idx ON content.genre_film_work (genre_id);",
+}
+
+# Failed or interrupted concurrent build leaves an invalid index, which is
+# skipped by IF NOT EXISTS, so it has to be dropped and built again
+SQL_INVALID_INDEXES = """
+    SELECT c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'content' AND c.relname = ANY(%s) AND NOT i.indisvalid;
+"""
+
+SQL_DROP_INDEX = """
+    DROP INDEX CONCURRENTLY IF EXISTS content.{};
 """
@@ -1,18 +1,41 @@
 import os
 from typing import Optional
 
+import orjson
 import psycopg2
 from elasticsearch import Elasticsearch, ConnectionError as ES_ConnectionError
 from psycopg2.extensions import connection as PGconnection
+from psycopg2.extras import register_default_jsonb
 
 from .backoff import backoff
+from .serializers import OrjsonSerializer
+
+# persons and genres come from Postgres as jsonb, they are parsed with orjson
+register_default_jsonb(globally=True, loads=orjson.loads)
 
 
 class ElasticConnection:
-    """Provides method for automatic reconnection to Elastic db."""
+    """Provides method for automatic reconnection to Elastic db.
+    Client is created once and shared by all instances, as it keeps
+    pool of HTTP connections itself.
+    """
+    _shared_client: Optional[Elasticsearch] = None
+
     def __init__(self) -> None:
         self.socket = {'host': os.getenv('ES_HOST'), 'port': os.getenv('ES_PORT')}
-        self._client = Elasticsearch([self.socket])
+        if ElasticConnection._shared_client is None:
+            ElasticConnection._shared_client = Elasticsearch(
+                [self.socket],
+                sniff_on_start=False,
+                # bulk bodies are repeated JSON field names, so they compress well
+                http_compress=True,
+                # enough connections for every thread sending bulk requests
+                maxsize=max(16, 2 * (os.cpu_count() or 1)),
+                timeout=60,
+                retry_on_timeout=True,
+                serializer=OrjsonSerializer(),
+            )
+        self._client = ElasticConnection._shared_client
 
     @backoff(exception=ES_ConnectionError, initial_backoff=1, max_backoff=60, max_retries=1000)
     def get_client(self) -> Optional[Elasticsearch]:
@@ -22,7 +45,11 @@ class ElasticConnection:
 
 
 class PostgresConnection:
-    """Provides method for automatic reconnection to Postgres db."""
+    """Provides method for automatic reconnection to Postgres db.
+    Connection is shared by all instances and reopened only if it was closed.
+    """
+    _shared_connection: Optional[PGconnection] = None
+
     def __init__(self) -> None:
         self.dsn = {
             'dbname': os.getenv('PG_DBNAME'),
@@ -31,8 +58,13 @@ class PostgresConnection:
             'host': os.getenv('PG_HOST'),
             'port': os.getenv('PG_PORT'),
             'options': os.getenv('PG_OPTIONS'),
+            # server sends text in the same encoding Python decodes it,
+            # so no conversion is needed on either side
+            'client_encoding': 'UTF8',
         }
 
     @backoff(exception=psycopg2.OperationalError, initial_backoff=1, max_backoff=60, max_retries=1000)
     def get_connection(self) -> Optional[PGconnection]:
-        return psycopg2.connect(**self.dsn)
+        if PostgresConnection._shared_connection is None or PostgresConnection._shared_connection.closed:
+            PostgresConnection._shared_connection = psycopg2.connect(**self.dsn)
+        return PostgresConnection._shared_connection
@@ -24,8 +24,14 @@ class JsonFileStorage(BaseStorage):
 
     def save_state(self, state: dict) -> None:
         """Save state to storage."""
-        with open(self.file_path, 'w') as state_json:
+        # State is written to a temporary file which then replaces the old one,
+        # so the state file is never left half-written
+        tmp_path = f'{os.fsdecode(self.file_path)}.tmp'
+        with open(tmp_path, 'w') as state_json:
             json.dump(state, state_json)
+            state_json.flush()
+            os.fsync(state_json.fileno())
+        os.replace(tmp_path, self.file_path)
 
     def retrieve_state(self) -> dict:
         """Get state from storage."""
@@ -51,6 +57,12 @@ class State:
         state[key] = value
         self.storage.save_state(state)
 
+    def update_state(self, values: dict) -> None:
+        """Set state for several keys at once."""
+        state = self.storage.retrieve_state()
+        state.update(values)
+        self.storage.save_state(state)
+
     def get_state(self, key: str) -> Any:
         """Get state by key."""
         state = self.storage.retrieve_state()
@@ -7,6 +7,7 @@ LOGGING_CONFIG = {
     "loggers": {
         "main": {},
         "backoff": {},
+        "pipeline": {},
     },
     "handlers": {
         "console": {
@@ -0,0 +1,62 @@
+"""Helpers for running ETL stages in separate threads.
+
+Stages are connected by bounded queues, so the producer is blocked when the
+consumer falls behind and memory consumption stays flat.
+"""
+import logging
+import queue
+import threading
+from logging import config
+from typing import Any, Iterable, Iterator
+
+from .logging_config import LOGGING_CONFIG
+
+config.dictConfig(LOGGING_CONFIG)
+logger = logging.getLogger('pipeline')
+
+# marks the end of data in the queue
+END_OF_DATA = object()
+# how often blocked stage checks whether the pipeline was stopped, seconds
+QUEUE_TIMEOUT = 1
+
+
+def put_to_queue(out_queue: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+    """Put item to queue waiting for a free slot until the pipeline is stopped.
+    Returns False if the item wasn't put because of stopping.
+    """
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=QUEUE_TIMEOUT)
+        except queue.Full:
+            continue
+        return True
+    return False
+
+
+def iterate_queue(in_queue: queue.Queue, stop_event: threading.Event) -> Iterator[Any]:
+    """Yield items from queue until the end of data or stopping of the pipeline."""
+    while not stop_event.is_set():
+        try:
+            item = in_queue.get(timeout=QUEUE_TIMEOUT)
+        except queue.Empty:
+            continue
+        if item is END_OF_DATA:
+            return
+        yield item
+
+
+def start_stage(items: Iterable[Any], out_queue: queue.Queue, stop_event: threading.Event) -> threading.Thread:
+    """Start thread which puts all items to the queue followed by END_OF_DATA."""
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put_to_queue(out_queue, item, stop_event):
+                    return
+        except Exception:
+            logger.exception('ETL stage failed ')
+        finally:
+            put_to_queue(out_queue, END_OF_DATA, stop_event)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    return thread
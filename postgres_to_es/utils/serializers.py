@@ -0,0 +1,26 @@
+import orjson
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+
+class OrjsonSerializer(JSONSerializer):
+    """JSON serializer for Elasticsearch client based on orjson.
+    Documents are serialized on every bulk request, so faster JSON codec
+    noticeably reduces CPU time of loading.
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, (str, bytes)):
+            return data
+
+        try:
+            return orjson.dumps(data, default=self.default).decode()
+        except (orjson.JSONEncodeError, TypeError) as e:
+            raise SerializationError(data, e)